@@ -3,6 +3,7 @@
 # dsahead python 3.7
 import json
 import os.path
+from time import monotonic
 import numpy as np
 #from sklearn import cluster  # for dbscan
 import hdbscan
@@ -22,6 +23,58 @@ logger.app('T2')
 offset = 1907
 downsample = 4
 
+# snap start time is kept current by etcd watches rather than polled every gulp.
+# cached values older than _snap_ttl seconds are re-read in case a watch died silently.
+_snap_keys = ['/mon/snap/1/armed_mjd', '/mon/snap/1/utc_start']
+_snap_ttl = 60.
+_snap_cache = {}
+_snap_read = {}
+_snap_watched = set()
+
+
+def _watch_snap(key):
+    """ Register etcd watch that keeps _snap_cache[key] up to date.
+    A callback without a dict stops trusting the watch for key.
+    """
+
+    # etcd3 passes a dropped watch stream's error to the dsautils wrapper, not to cb directly.
+    # if the wrapper parses event.events before calling cb, that error never reaches the else
+    # branch below and only _snap_ttl protects against a silently dead watch.
+    def cb(val):
+        if isinstance(val, dict):
+            _snap_cache[key] = val
+            _snap_read[key] = monotonic()
+        else:
+            logger.warning(f'Unexpected etcd watch value for {key}: {val}. Will poll it every gulp.')
+            _snap_watched.discard(key)
+
+    try:
+        ds.add_watch(key, cb)
+        _snap_watched.add(key)
+    except Exception:
+        logger.warning(f'Could not add etcd watch on {key}. Will poll it every gulp.')
+
+
+for _key in _snap_keys:
+    _watch_snap(_key)
+
+
+def get_ret_time():
+    """ Get MJD of snap start from cached etcd values.
+    Reads a key from etcd if it is not watched, has no cached value or the value is older than _snap_ttl.
+    """
+
+    now = monotonic()
+    for key in _snap_keys:
+        if (key not in _snap_watched or _snap_cache.get(key) is None
+                or now - _snap_read.get(key, 0.) > _snap_ttl):
+            _snap_cache[key] = ds.get_dict(key)
+            _snap_read[key] = now
+
+    armed_mjd = _snap_cache['/mon/snap/1/armed_mjd']['armed_mjd']
+    utc_start = float(_snap_cache['/mon/snap/1/utc_start']['utc_start'])
+    return armed_mjd+utc_start*4.*8.192e-6/86400.
+
 
 def parse_candsfile(candsfile):
     """ Takes standard MBHeimdall giants output and returns full table, classifier inputs and snr tables.
@@ -64,7 +117,7 @@ def parse_candsfile(candsfile):
     tab['ibeam'] = tab['ibeam'].astype(int)
     if hdfile is True:
         try:
-            ret_time = ds.get_dict('/mon/snap/1/armed_mjd')['armed_mjd']+float(ds.get_dict('/mon/snap/1/utc_start')['utc_start'])*4.*8.192e-6/86400.
+            ret_time = get_ret_time()
         except:
             ret_time = 55000.0
         tab['mjds'] = tab['mjds']/86400.+ret_time
@@ -101,8 +154,7 @@ def cluster_data(tab, selectcols=['itime', 'idm', 'ibox', 'ibeam'], min_cluster_
 
     logger.info(f'Found {nclustered} clustered and {nunclustered} unclustered rows')
 
-    # hack assumes fixed columns
-    bl = data[:, 3]
+    bl = np.asarray(tab['ibeam'])
     cntb, cntc = np.zeros((len(data), 1), dtype=int), np.zeros((len(data), 1), dtype=int)
     ucl = np.unique(cl)
 
@@ -145,13 +197,11 @@ def get_peak(tab):
         if i == -1:
             continue
         clusterinds = np.where(i == cl)[0]
-        maxsnr = snrs[clusterinds].max()
-        imaxsnr = np.where(snrs == maxsnr)[0][0]
+        imaxsnr = clusterinds[np.argmax(snrs[clusterinds])]
         ipeak.append(imaxsnr)
 #        clsnr.append((imaxsnr, maxsnr, cnt_beam[imaxsnr], cnt_cl[imaxsnr]))
     ipeak += [i for i in range(len(tab)) if cl[i] == -1]  # append unclustered
-    logger.info(f"Cluster peaks at {ipeak}:\n{tab[ipeak]}")
-    print(f"Cluster peaks at {ipeak}:\n{tab[ipeak]}")
+    logger.info(f"Found {len(ipeak)} cluster peaks")
 
     return tab[ipeak]
 
@@ -168,41 +218,38 @@ def filter_clustered(tab, min_snr=None, min_dm=None, max_ibox=None, min_cntb=Non
     else:
         min_dmt, max_dmt, min_snrt = None, None, None
 
-    good = [True] * len(tab)
+    # single boolean mask, updated in place by each predicate
+    snr = np.asarray(tab['snr'])
+    dm = np.asarray(tab['dm'])
+    good = np.ones(len(tab), dtype=bool)
 
     if min_snr is not None:
         if min_snrt is None:
-            good *= tab['snr'] > min_snr
+            good &= snr > min_snr
         else:
             #print(f'min_snr={min_snr}, min_snrt={min_snrt}, min_dmt={min_dmt}, max_dmt={max_dmt}, tab={tab[["snr", "dm"]]}')
-            good0 = (tab['snr'] > min_snr)*(tab['dm'] > max_dmt)
-            good1 = (tab['snr'] > min_snr)*(tab['dm'] < min_dmt)
-            good2 = (tab['snr'] > min_snrt)*(tab['dm'] > min_dmt)*(tab['dm'] < max_dmt)
-            good *= good0 + good1 + good2
-            #print('good0, good1, good2, good:')
-            #print(good0, good1, good2, good)
+            intarget = (dm > min_dmt) & (dm < max_dmt)
+            outtarget = (dm > max_dmt) | (dm < min_dmt)
+            good &= ((snr > min_snr) & outtarget) | ((snr > min_snrt) & intarget)
     if min_dm is not None:
-        good *= tab['dm'] > min_dm
+        good &= dm > min_dm
     if max_ibox is not None:
-        good *= tab['ibox'] < max_ibox
+        good &= np.asarray(tab['ibox']) < max_ibox
     if min_cntb is not None:
-        good *= tab['cntb'] > min_cntb
+        good &= np.asarray(tab['cntb']) > min_cntb
     if max_cntb is not None:
-        good *= tab['cntb'] < max_cntb
+        good &= np.asarray(tab['cntb']) < max_cntb
     if min_cntc is not None:
-        good *= tab['cntc'] > min_cntc
+        good &= np.asarray(tab['cntc']) > min_cntc
     if max_cntc is not None:
-        good *= tab['cntc'] < max_cntc
+        good &= np.asarray(tab['cntc']) < max_cntc
 
     #    clsnr_out.append((imaxsnr, snr, cntb, cntc))
     tab_out = tab[good]
 
     # calculate nbeams_gulp over 7.5
-    goody = [True] * len(tab)
-    goody *= tab['snr'] > 7.5
-    tab_out2 = tab[goody]
-    if len(tab_out2)>0:
-        ibeams = np.asarray(tab_out2['ibeam'])
+    ibeams = np.asarray(tab['ibeam'])[snr > 7.5]
+    if len(ibeams)>0:
         nbeams_gulp = len(np.unique(ibeams))
     else:
         nbeams_gulp = None
@@ -230,8 +277,8 @@ def dump_cluster_results_json(tab, outputfile=None, output_cols=['mjds', 'snr',
         coords, snrs = triggering.parse_catalog(cat)
     
     itimes = tab['itime']
-    maxsnr = tab['snr'].max()
-    imaxsnr = np.where(tab['snr'] == maxsnr)[0][0]
+    imaxsnr = np.argmax(tab['snr'])
+    maxsnr = tab['snr'][imaxsnr]
     itime = str(itimes[imaxsnr])
     specnum = (int(itimes[imaxsnr])-offset)*downsample
     mjd = tab['mjds'][imaxsnr]
@@ -350,9 +397,7 @@ def dump_cluster_results_heimdall(tab, outputfile, min_snr_t2out=None):
     tab['itime'] = (tab['itime']-offset)*downsample  # transform to specnum
 
     if min_snr_t2out is not None:
-        good = [True] * len(tab)
-        good *= tab['snr'] > min_snr_t2out
-        tab = tab[good]
+        tab = tab[np.asarray(tab['snr']) > min_snr_t2out]
 
     if len(tab)>0:
         tab.write(outputfile, format='ascii.no_header')
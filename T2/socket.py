@@ -1,10 +1,12 @@
 import numpy as np
 import socket 
+import selectors
 from T2 import cluster_heimdall
 from T2 import triggering
 import time
-from astropy.time import Time
-import datetime
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from event import names
 from etcd3.exceptions import ConnectionFailedError
 
@@ -22,6 +24,34 @@ except (KeyError, ConnectionFailedError):
     my_cnf = cnf.Conf(use_etcd=False)
     t2_cnf = my_cnf.get('t2')
 
+# filtering and triggering thresholds. static for the life of the process.
+MIN_DM = t2_cnf['min_dm']  # smallest dm in filtering
+MAX_IBOX = t2_cnf['max_ibox']  # largest ibox in filtering
+MIN_SNR = t2_cnf['min_snr']  # smallest snr in filtering
+MIN_SNR_T2OUT = t2_cnf['min_snr_t2out']  # smallest snr to write T2 output cand file
+MAX_NCL = t2_cnf['max_ncl']  # largest number of clusters allowed in triggering
+MAX_CNTB = t2_cnf['max_ctb']
+TARGET_PARAMS = (25., 50., 50.)  # Galactic bursts
+
+# service keys advertise a 60 s cadence. write them twice per cadence at most.
+MON_CADENCE = 60
+_mon_last = {}
+
+# monitor writes are handed to a background thread so etcd never blocks the socket loop.
+# bounded so a stuck etcd drops monitor updates rather than growing without limit.
+# the writer thread is started by the first put_service call, not at import.
+_mon_q = queue.Queue(maxsize=100)
+_mon_thread = None
+
+# T2 output files are written off the gulp loop. one worker keeps writes in order.
+_write_pool = ThreadPoolExecutor(max_workers=1)
+
+# reused by recvall across gulps. grows as needed, but is reset to RECV_BUF_SIZE
+# after a read that grew it past RECV_BUF_MAX so one large gulp is not kept resident.
+RECV_BUF_SIZE = 1 << 20
+RECV_BUF_MAX = 16 << 20
+_recv_buf = bytearray(RECV_BUF_SIZE)
+
 
 def parse_socket(host, ports, selectcols=['itime', 'idm', 'ibox', 'ibeam'], outroot=None, plot_dir=None, trigger=False, source_catalog=None):
     """ 
@@ -44,7 +74,7 @@ def parse_socket(host, ports, selectcols=['itime', 'idm', 'ibox', 'ibeam'], outr
 
     lastname = names.get_lastname()
 
-    ss = []
+    ss = make_listeners(host, ports)
 
     # pre-calculate beam model and get source catalog
     if source_catalog is not None:
@@ -56,48 +86,39 @@ def parse_socket(host, ports, selectcols=['itime', 'idm', 'ibox', 'ibeam'], outr
         snrs=None
     
     while True:
-        if len(ss) != len(ports):
-            for port in ports:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-                s.bind((host, port))    # assigns the socket with an address
-                s.listen(1)             # accept no. of incoming connections
-                ss.append(s)
-
-        ds.put_dict('/mon/service/T2service',
-                    {"cadence": 60, "time": Time(datetime.datetime.utcnow()).mjd})
+        put_service('/mon/service/T2service')
 
-        cls = []
         try:
-            for s in ss:
-                clientsocket, address = s.accept() # stores the socket details in 2 variables
-                logger.info(f"Connection from {address} has been established")
-                cls.append(clientsocket)
+            cls = accept_clients(ss)
         except KeyboardInterrupt:
             logger.info("Escaping socket connection")
             break
 
+        if cls is None:
+            logger.info("Received stop command. Escaping socket connection")
+            break
+
         # read in heimdall socket output  
         logger.info(f"Reading candsfile from {len(cls)} sockets...")
         print(f"Reading candsfile from {len(cls)} sockets...")
-        candsfile = ''
+        raw_parts = []
         gulps = []
         for cl in cls:
-            cf = recvall(cl, 100000000).decode('utf-8')
+            cf = recvall(cl, 100000000)
 
-            gulp, *lines = cf.split('\n')
             try:
-                gulp = int(gulp)
+                gulp, lines = split_payload(cf)
 #                print(f"received gulp {gulp} with {len(lines)-1} lines")
-            except ValueError:
-                print(f'Could not get int from this read ({gulp}). Skipping this client.')
+            except ValueError as exc:
+                print(f'Could not get int from this read ({exc}). Skipping this client.')
                 continue
 
             gulps.append(gulp)
             cl.close()
 
-            if len(lines) > 1:
-                if len(lines[0]) > 0:
-                    candsfile += '\n'.join(lines)
+            if lines:
+                raw_parts.append(lines)
+        candsfile = b''.join(raw_parts).decode('utf-8')
 
         print(f'Received gulp_i {gulps}')
         if len(gulps) != len(cls):
@@ -105,25 +126,12 @@ def parse_socket(host, ports, selectcols=['itime', 'idm', 'ibox', 'ibeam'], outr
             continue
                 
         if len(set(gulps)) > 1:
-            logger.info(f"not all clients received from same gulp: {set(gulps)}. Restarting socket connections.")
-            print(f"not all clients received from same gulp: {set(gulps)}. Restarting socket connections.")
-
-            for s in ss:
-                s.close()
-            ss = []
-            for port in ports:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                try:
-                    s.bind((host, port))    # assigns the socket with an address
-                except OSError:
-                    print('socket bind failed.')
-                    continue
-                s.listen(1)             # accept no. of incoming connections
-                ss.append(s)
+            logger.info(f"not all clients received from same gulp: {set(gulps)}. Dropping pending connections.")
+            print(f"not all clients received from same gulp: {set(gulps)}. Dropping pending connections.")
+            drain_clients(ss)
             continue
         else:
-            ds.put_dict('/mon/service/T2gulp',
-                        {"cadence": 60, "time": Time(datetime.datetime.utcnow()).mjd})
+            put_service('/mon/service/T2gulp')
 
         if candsfile == '\n' or candsfile == '':  # skip empty candsfile
             continue
@@ -156,20 +164,13 @@ def cluster_and_plot(tab, gulp_i, selectcols=['itime', 'idm', 'ibox', 'ibeam'],
     coords and snrs: from source catalog (default None)
     """
 
-    # TODO: put these in json config file
-    min_dm = t2_cnf['min_dm']  # smallest dm in filtering
-    max_ibox = t2_cnf['max_ibox']  # largest ibox in filtering
-    min_snr = t2_cnf['min_snr']  # smallest snr in filtering
-    min_snr_t2out = t2_cnf['min_snr_t2out']  # smallest snr to write T2 output cand file
     if max_ncl is None:
-        max_ncl = t2_cnf['max_ncl']  # largest number of clusters allowed in triggering
-    max_cntb = t2_cnf['max_ctb']
-    target_params = (25., 50., 50.)  # Galactic bursts
+        max_ncl = MAX_NCL
 
     # cluster
     cluster_heimdall.cluster_data(tab, metric='euclidean', allow_single_cluster=True, return_clusterer=False)
     tab2 = cluster_heimdall.get_peak(tab)
-    tab3,nbeams_gulp = cluster_heimdall.filter_clustered(tab2, min_snr=min_snr, min_dm=min_dm, max_ibox=max_ibox, max_cntb=max_cntb, target_params=target_params)
+    tab3,nbeams_gulp = cluster_heimdall.filter_clustered(tab2, min_snr=MIN_SNR, min_dm=MIN_DM, max_ibox=MAX_IBOX, max_cntb=MAX_CNTB, target_params=TARGET_PARAMS)
     #tab3 = cluster_heimdall.filter_clustered(tab2, min_snr=min_snr, min_dm=min_dm, max_ibox=max_ibox, max_cntb=max_cntb)
 
     col_trigger = np.zeros(len(tab2), dtype=int)
@@ -181,29 +182,269 @@ def cluster_and_plot(tab, gulp_i, selectcols=['itime', 'idm', 'ibox', 'ibeam'],
                                                                     coords=coords, snrs=snrs, outroot=outroot,
                                                                     nbeams_gulp=nbeams_gulp)
         if tab4 is not None and trigger:
-            col_trigger = np.where(tab4 == tab2, lastname, 0)  # if trigger, then overload
+            triggered = match_row(tab2, tab4)
+            col_trigger = np.where(triggered, lastname, 0)  # if trigger, then overload
 
     # write T2 cluster results
     if outroot is not None and len(tab2):
         tab2['trigger'] = col_trigger
-        cluster_heimdall.dump_cluster_results_heimdall(tab2, outroot+str(np.floor(time.time()).astype('int'))+".cand",
-                                                       min_snr_t2out=min_snr_t2out)
+        _write_pool.submit(write_cand, tab2, outroot+str(np.floor(time.time()).astype('int'))+".cand")
         
     return lastname
 
 
+def pack_keys(tab):
+    """
+    Pack itime, idm, ibeam and ibox of each row (or a single row) into one int64 key.
+    Bits are itime<<32 | idm<<20 | ibeam<<10 | ibox.
+    Returns None if any value is negative or too wide for its field, since it would collide with another key.
+    """
+
+    cols = []
+    for col, nbits in (('itime', 31), ('idm', 12), ('ibeam', 10), ('ibox', 10)):
+        val = np.asarray(tab[col], dtype=np.int64)
+        if np.any((val < 0) | (val >= 1 << nbits)):
+            return None
+        cols.append(val)
+    itime, idm, ibeam, ibox = cols
+
+    return (itime << 32) | (idm << 20) | (ibeam << 10) | ibox
+
+
+def match_row(tab, row):
+    """
+    Boolean mask of rows in tab that match row.
+    Uses packed integer keys when they fit, otherwise compares all fields of row with tab.
+    """
+
+    keys = pack_keys(tab)
+    key = pack_keys(row)
+    if keys is None or key is None:
+        logger.info('Row keys out of range for packing. Comparing full rows.')
+        return np.asarray(row == tab)
+
+    return np.isin(keys, key)
+
+
+def write_cand(tab, outputfile):
+    """
+    Write T2 cluster results to outputfile. Run on _write_pool.
+    Errors are logged, since nothing waits on the result.
+    """
+
+    try:
+        cluster_heimdall.dump_cluster_results_heimdall(tab, outputfile, min_snr_t2out=MIN_SNR_T2OUT)
+    except Exception as exc:
+        logger.warning(f'Could not write T2 output {outputfile}: {exc}')
+
+
+def mjd_now():
+    """
+    Current MJD (UTC) from the system clock. MJD 40587 is the unix epoch.
+    Much cheaper than constructing an astropy Time.
+    """
+
+    return time.time()/86400. + 40587.
+
+
+def put_service(key):
+    """
+    Write service heartbeat for key to etcd.
+    Skipped if key was written less than half of MON_CADENCE ago.
+    """
+
+    now = time.time()
+    if now - _mon_last.get(key, 0.) < MON_CADENCE/2:
+        return
+
+    _mon_last[key] = now
+    start_mon()
+    try:
+        _mon_q.put_nowait((key, {"cadence": MON_CADENCE, "time": mjd_now()}))
+    except queue.Full:
+        logger.debug(f'Monitor queue full. Dropping update for {key}.')
+
+
+def start_mon():
+    """
+    Start the background monitor writer thread, if not already running.
+    """
+
+    global _mon_thread
+
+    if _mon_thread is None:
+        _mon_thread = threading.Thread(target=_drain_mon, daemon=True)
+        _mon_thread.start()
+
+
+def write_mon_batch():
+    """
+    Wait for a queued monitor dict, then write it and everything else queued to etcd.
+    Only the latest payload per key is written.
+    """
+
+    key, payload = _mon_q.get()
+    pending = {key: payload}
+    while True:
+        try:
+            key, payload = _mon_q.get_nowait()
+        except queue.Empty:
+            break
+        pending[key] = payload
+
+    for key, payload in pending.items():
+        try:
+            ds.put_dict(key, payload)
+        except Exception as exc:
+            logger.warning(f'Could not write {key} to etcd: {exc}')
+
+
+def _drain_mon():
+    """
+    Write queued monitor dicts to etcd, at most one batch per second.
+    """
+
+    while True:
+        write_mon_batch()
+        time.sleep(1)
+
+
+def make_listeners(host, ports, rcvbuf=None):
+    """
+    Create one listening socket per port. Called once per parse_socket.
+    SO_REUSEADDR lets a restarted T2 rebind while old connections are in TIME_WAIT.
+    rcvbuf optionally sets SO_RCVBUF, which accepted client sockets inherit.
+    Default None leaves it unset: on Linux an explicit SO_RCVBUF disables receive-buffer
+    autotuning and is capped by net.core.rmem_max.
+    Returns list of listening sockets.
+    """
+
+    ss = []
+    for port in ports:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if rcvbuf is not None:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            logger.info(f"Requested SO_RCVBUF {rcvbuf} on port {port}, got {s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)}")
+        s.bind((host, port))    # assigns the socket with an address
+        s.listen(1)             # accept no. of incoming connections
+        ss.append(s)
+
+    return ss
+
+
+def accept_clients(ss, timeout=5.):
+    """
+    Accept one client connection on each listening socket in ss.
+    Clients are accepted in the order they connect, so total wait is set by the slowest client.
+    While no client is connecting, the service heartbeat and /cmd/T2 are checked every timeout seconds.
+    Returns list of client sockets, or None if a stop command was received.
+    """
+
+    cls = []
+    with selectors.DefaultSelector() as sel:
+        for s in ss:
+            sel.register(s, selectors.EVENT_READ)
+
+        while sel.get_map():
+            events = sel.select(timeout=timeout)
+            if not events:
+                put_service('/mon/service/T2service')
+                if stop_requested():
+                    for cl in cls:
+                        cl.close()
+                    return None
+                continue
+
+            for key, _ in events:
+                clientsocket, address = key.fileobj.accept() # stores the socket details in 2 variables
+                logger.info(f"Connection from {address} has been established")
+                cls.append(clientsocket)
+                sel.unregister(key.fileobj)
+
+    return cls
+
+
+def stop_requested():
+    """
+    Check etcd for {"cmd": "stop"} at /cmd/T2.
+    The command is acknowledged by overwriting it, so a restarted T2 does not stop again.
+    """
+
+    try:
+        cmd = ds.get_dict('/cmd/T2')
+    except Exception:
+        return False
+
+    if not cmd or cmd.get('cmd') != 'stop':
+        return False
+
+    try:
+        ds.put_dict('/cmd/T2', {'cmd': 'stopped', 'time': mjd_now()})
+    except Exception as exc:
+        logger.warning(f'Could not acknowledge stop command: {exc}')
+    return True
+
+
+def drain_clients(ss):
+    """
+    Accept and close any connections already queued on the listening sockets in ss.
+    Used to resynchronize clients without tearing down and rebinding the listeners.
+    """
+
+    with selectors.DefaultSelector() as sel:
+        for s in ss:
+            sel.register(s, selectors.EVENT_READ)
+
+        events = sel.select(timeout=0)
+        while events:
+            for key, _ in events:
+                clientsocket, address = key.fileobj.accept()
+                logger.info(f"Dropping connection from {address}")
+                clientsocket.close()
+            events = sel.select(timeout=0)
+
+
+def split_payload(cf):
+    """
+    Split raw client payload into gulp number (first line) and candidate lines.
+    Only the first line is decoded. Lines are returned as b'' if there are no candidates to keep.
+    Raises ValueError if the first line is not an integer.
+    """
+
+    gulp, _, lines = cf.partition(b'\n')
+    gulp = int(gulp)
+    if b'\n' not in lines or lines.startswith(b'\n'):
+        lines = b''
+
+    return gulp, lines
+
+
 def recvall(sock, n):
     """
     helper function to receive all bytes from a socket
     sock: open socket
     n: maximum number of bytes to expect. you can make this ginormous!
+    Reads directly into a reusable module-level buffer that is doubled when full.
     """
 
-    data = bytearray()
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
-            return data
-        data.extend(packet)
+    global _recv_buf
+
+    view = memoryview(_recv_buf)
+    filled = 0
+    while filled < n:
+        if filled == len(_recv_buf):
+            view.release()
+            _recv_buf.extend(bytes(len(_recv_buf)))
+            view = memoryview(_recv_buf)
+        nbytes = sock.recv_into(view[filled:min(len(_recv_buf), n)])
+        if not nbytes:
+            break
+        filled += nbytes
+
+    data = view[:filled].tobytes()
+    view.release()
+    if len(_recv_buf) > RECV_BUF_MAX:
+        _recv_buf = bytearray(RECV_BUF_SIZE)
 
     return data
@@ -1,5 +1,6 @@
 import pytest
 import os.path
+from astropy.table import Table
 from T2 import cluster_heimdall, plotting
 
 _install_dir = os.path.abspath(os.path.dirname(__file__))
@@ -34,6 +35,19 @@ def test_peak(tab):
     # assert cc ==
 
 
+def test_peak_equal_snr():
+    """ Clusters with equal max snr each get a peak from their own cluster.
+    """
+
+    tab = Table({'snr': [10., 8., 9., 10.], 'cl': [0, 0, 1, 1], 'ibeam': [1, 1, 2, 2]})
+    tab2 = cluster_heimdall.get_peak(tab)
+
+    assert len(tab2) == 2
+    assert list(tab2['cl']) == [0, 1]
+    assert list(tab2['ibeam']) == [1, 2]
+    assert list(tab2['snr']) == [10., 10.]
+
+
 def test_filter(tab):
     cluster_heimdall.cluster_data(tab, return_clusterer=False)
     tab2 = cluster_heimdall.get_peak(tab)
@@ -71,3 +85,79 @@ def test_plot_bt(tab):
 
 def test_giantst(tab):
     plotting.plot_giants(tab, plot_dir=os.path.join(_install_dir, 'plot_'))
+
+
+class SnapStore:
+    """ Stands in for DsaStore. Serves snap keys from vals and keeps watch callbacks.
+    """
+
+    def __init__(self, vals):
+        self.vals = vals
+        self.reads = []
+        self.cbs = {}
+
+    def get_dict(self, key):
+        self.reads.append(key)
+        return self.vals.get(key)
+
+    def add_watch(self, key, cb):
+        self.cbs[key] = cb
+
+
+snap_vals = {'/mon/snap/1/armed_mjd': {'armed_mjd': 59000.}, '/mon/snap/1/utc_start': {'utc_start': '1000'}}
+snap_mjd = 59000.+1000*4.*8.192e-6/86400.
+
+
+@pytest.fixture
+def snapstore(monkeypatch):
+    """ Fresh snap cache with watches registered on a stub store.
+    """
+
+    store = SnapStore(snap_vals)
+    monkeypatch.setattr(cluster_heimdall, 'ds', store)
+    monkeypatch.setattr(cluster_heimdall, '_snap_cache', {})
+    monkeypatch.setattr(cluster_heimdall, '_snap_read', {})
+    monkeypatch.setattr(cluster_heimdall, '_snap_watched', set())
+    for key in cluster_heimdall._snap_keys:
+        cluster_heimdall._watch_snap(key)
+    return store
+
+
+def test_snap_watched_fresh(snapstore):
+    for key, val in snap_vals.items():
+        snapstore.cbs[key](val)
+
+    assert cluster_heimdall.get_ret_time() == snap_mjd
+    assert snapstore.reads == []
+
+
+def test_snap_ttl(snapstore):
+    for key, val in snap_vals.items():
+        snapstore.cbs[key](val)
+    for key in cluster_heimdall._snap_keys:
+        cluster_heimdall._snap_read[key] -= cluster_heimdall._snap_ttl+1
+
+    assert cluster_heimdall.get_ret_time() == snap_mjd
+    assert sorted(snapstore.reads) == sorted(cluster_heimdall._snap_keys)
+
+
+def test_snap_watch_error(snapstore):
+    for key, val in snap_vals.items():
+        snapstore.cbs[key](val)
+    snapstore.cbs['/mon/snap/1/armed_mjd'](Exception('watch stream dropped'))
+
+    assert '/mon/snap/1/armed_mjd' not in cluster_heimdall._snap_watched
+    cluster_heimdall.get_ret_time()
+    cluster_heimdall.get_ret_time()
+    assert snapstore.reads == ['/mon/snap/1/armed_mjd'] * 2
+
+
+def test_snap_missing(snapstore):
+    """ Missing snap keys fall back to ret_time 55000.0.
+    """
+
+    snapstore.vals = {}
+    candsfile = os.path.join(_install_dir, 'data/giants.cand')
+    tab = cluster_heimdall.parse_candsfile(candsfile)
+
+    assert tab['mjds'][0] == pytest.approx(22.5468/86400.+55000.0)
@@ -0,0 +1,241 @@
+import pytest
+import queue
+import socket
+import selectors
+import threading
+import time
+import numpy as np
+from astropy.table import Table
+from T2 import socket as t2socket
+
+
+@pytest.fixture
+def keytab():
+    return Table({'snr': [10., 9., 8., 7.],
+                  'itime': [100, 100, 200, 300],
+                  'idm': [5, 6, 5, 5],
+                  'ibeam': [1, 1, 1, 2],
+                  'ibox': [2, 2, 2, 4]})
+
+
+def test_match_row(keytab):
+    """ Packed keys select the same rows as comparing the full row.
+    """
+
+    for row in keytab:
+        assert (t2socket.match_row(keytab, row) == np.asarray(row == keytab)).all()
+
+
+def test_match_row_out_of_range():
+    """ Values too wide for the packed layout fall back to comparing full rows.
+    """
+
+    # idm=4097 overflows into itime, so both rows would pack to the same key
+    tab = Table({'snr': [10., 9.], 'itime': [100, 101], 'idm': [4097, 1], 'ibeam': [0, 0], 'ibox': [0, 0]})
+
+    assert t2socket.pack_keys(tab) is None
+    assert list(t2socket.match_row(tab, tab[0])) == [True, False]
+
+
+def _send(data):
+    """ Socket pair whose reading end receives data, then EOF.
+    """
+
+    reader, writer = socket.socketpair()
+    threading.Thread(target=lambda: (writer.sendall(data), writer.close())).start()
+    return reader
+
+
+@pytest.mark.parametrize('size', [0, 1 << 20, (1 << 20)+1, 5 << 20])
+def test_recvall(size):
+    data = bytes(range(256)) * (size // 256) + bytes(range(size % 256))
+    reader = _send(data)
+    assert t2socket.recvall(reader, 100000000) == data
+    reader.close()
+
+
+def test_recvall_limit():
+    reader = _send(b'0123456789')
+    assert t2socket.recvall(reader, 4) == b'0123'
+    reader.close()
+
+
+def test_recvall_shrinks_buffer():
+    """ A read that grows the shared buffer past RECV_BUF_MAX does not keep it resident.
+    """
+
+    data = b'x' * (t2socket.RECV_BUF_MAX+1)
+    reader = _send(data)
+    assert t2socket.recvall(reader, 100000000) == data
+    assert len(t2socket._recv_buf) == t2socket.RECV_BUF_SIZE
+    reader.close()
+
+
+def test_split_payload():
+    assert t2socket.split_payload(b'12\n10.1 1 2\n11.0 1 3\n') == (12, b'10.1 1 2\n11.0 1 3\n')
+    assert t2socket.split_payload(b'12\n') == (12, b'')
+    assert t2socket.split_payload(b'12') == (12, b'')
+    assert t2socket.split_payload(b'12\n10.1 1 2') == (12, b'')  # no complete line
+    assert t2socket.split_payload(b'12\n\n10.1 1 2\n') == (12, b'')  # empty first line
+
+    with pytest.raises(ValueError):
+        t2socket.split_payload(b'gulp\n10.1 1 2\n')
+
+
+class StubStore:
+    """ Stands in for DsaStore. get_dict always returns cmd.
+    """
+
+    def __init__(self, cmd=None):
+        self.cmd = cmd
+        self.puts = []
+
+    def get_dict(self, key):
+        return self.cmd
+
+    def put_dict(self, key, val):
+        self.puts.append((key, val))
+
+
+@pytest.fixture
+def stubbed(monkeypatch):
+    """ Stub etcd store and record service heartbeats.
+    """
+
+    heartbeats = []
+    monkeypatch.setattr(t2socket, 'ds', StubStore())
+    monkeypatch.setattr(t2socket, 'put_service', heartbeats.append)
+    return heartbeats
+
+
+def test_write_mon_batch(monkeypatch):
+    """ Queued monitor dicts are written once per key, with the latest payload.
+    """
+
+    store = StubStore()
+    monkeypatch.setattr(t2socket, 'ds', store)
+    monkeypatch.setattr(t2socket, '_mon_q', queue.Queue())
+    t2socket._mon_q.put(('/mon/service/T2service', {'time': 1.}))
+    t2socket._mon_q.put(('/mon/service/T2gulp', {'time': 2.}))
+    t2socket._mon_q.put(('/mon/service/T2service', {'time': 3.}))
+
+    t2socket.write_mon_batch()
+
+    assert sorted(store.puts) == [('/mon/service/T2gulp', {'time': 2.}),
+                                  ('/mon/service/T2service', {'time': 3.})]
+
+
+def test_put_service_starts_mon(monkeypatch):
+    """ The monitor writer thread is started by the first put_service, not at import.
+    """
+
+    started = []
+    monkeypatch.setattr(t2socket, '_mon_thread', None)
+    monkeypatch.setattr(t2socket, '_mon_q', queue.Queue())
+    monkeypatch.setattr(t2socket, '_mon_last', {})
+    monkeypatch.setattr(t2socket, '_drain_mon', lambda: started.append(True))
+
+    t2socket.put_service('/mon/service/T2service')
+    t2socket._mon_thread.join(1.)
+
+    assert started == [True]
+    assert t2socket._mon_q.get_nowait()[0] == '/mon/service/T2service'
+
+
+def _listeners(n):
+    ss = t2socket.make_listeners('127.0.0.1', [0] * n)
+    ports = [s.getsockname()[1] for s in ss]
+    return ss, ports
+
+
+def _connect(port, delay=0.):
+    """ Connect to port after delay seconds. Returns list that gets the client socket.
+    """
+
+    conn = []
+    def run():
+        time.sleep(delay)
+        conn.append(socket.create_connection(('127.0.0.1', port)))
+    thread = threading.Thread(target=run)
+    thread.start()
+    return conn, thread
+
+
+def _is_closed(sock):
+    sock.settimeout(1.)
+    return sock.recv(1) == b''
+
+
+def test_accept_clients(stubbed):
+    ss, ports = _listeners(2)
+    conns = [_connect(port, delay) for port, delay in zip(ports, [0.2, 0.])]
+
+    cls = t2socket.accept_clients(ss, timeout=1.)
+    assert len(cls) == 2
+
+    for conn, thread in conns:
+        thread.join()
+        conn[0].close()
+    for cl in cls:
+        cl.close()
+    for s in ss:
+        s.close()
+
+
+def test_accept_clients_idle_heartbeat(stubbed):
+    ss, ports = _listeners(1)
+    conn, thread = _connect(ports[0], delay=0.5)
+
+    cls = t2socket.accept_clients(ss, timeout=0.1)
+    assert len(cls) == 1
+    assert stubbed and set(stubbed) == {'/mon/service/T2service'}
+
+    thread.join()
+    cls[0].close()
+    conn[0].close()
+    ss[0].close()
+
+
+def test_accept_clients_stop(stubbed):
+    t2socket.ds.cmd = {'cmd': 'stop'}
+    ss, ports = _listeners(2)
+    conn, thread = _connect(ports[0])
+    thread.join()
+
+    assert t2socket.accept_clients(ss, timeout=0.1) is None
+    assert _is_closed(conn[0])  # client accepted before stop was closed
+    assert t2socket.ds.puts[-1][0] == '/cmd/T2'
+    assert t2socket.ds.puts[-1][1]['cmd'] == 'stopped'
+
+    conn[0].close()
+    for s in ss:
+        s.close()
+
+
+def test_stop_requested(stubbed):
+    assert not t2socket.stop_requested()
+    t2socket.ds.cmd = {'cmd': 'trigger'}
+    assert not t2socket.stop_requested()
+    t2socket.ds.cmd = {'cmd': 'stop'}
+    assert t2socket.stop_requested()
+
+
+def test_drain_clients(stubbed):
+    ss, ports = _listeners(2)
+    conns = [_connect(port) for port in ports + ports[:1]]
+    for conn, thread in conns:
+        thread.join()
+    time.sleep(0.1)
+
+    t2socket.drain_clients(ss)
+    for conn, thread in conns:
+        assert _is_closed(conn[0])
+        conn[0].close()
+
+    with selectors.DefaultSelector() as sel:
+        for s in ss:
+            sel.register(s, selectors.EVENT_READ)
+        assert not sel.select(timeout=0)
+
+    for s in ss:
+        s.close()